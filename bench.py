@@ -0,0 +1,303 @@
+"""Load test for canon.py against local stand-ins for Discord, OpenAI and the code guessing server.
+
+    python bench.py [--scale 1.0] [--only relay,meows] [--output bench.json]
+
+Nothing here talks to the network: canon.py is imported with a generated config in a scratch directory,
+its Discord objects are replaced with fakes that take a fixed time to "send", GPT rewrites go through
+config.gpt_backend, and /cg is pointed at a tiny aiohttp server. Results are printed and written as JSON
+so that runs on different commits can be compared.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import discord
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# how long the stand-ins take to answer
+SEND_LATENCY = 0.05
+GPT_LATENCY = (0.05, 0.3)
+
+GUILD = 1
+BRIDGE = 100
+ROTG = 101
+# fewer than there are toki pona names, since each gets one
+USERS = range(1000, 3500)
+
+CG_PAGE = """<html><body><h1>round #50 stage 2</h1><p>ends <time datetime="2030-01-01T00:00:00+00:00">soon</time></p></body></html>"""
+
+
+class FakeUser:
+    bot = False
+
+    def __init__(self, id):
+        self.id = id
+        self.display_name = f"user{id}"
+        self.mention = f"<@{id}>"
+
+    def get_role(self, id):
+        # everyone has the odd roles
+        return id % 2 or None
+
+    async def send(self, content, files=()):
+        await asyncio.sleep(SEND_LATENCY)
+        received(content)
+
+
+class FakeChannel(discord.TextChannel):
+    def __init__(self, id):
+        self.id = id
+        self.guild = fake_guild
+
+    async def send(self, content, files=()):
+        await asyncio.sleep(SEND_LATENCY)
+        received(content)
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+
+    def get_member(self, id):
+        return users.get(id)
+
+    def get_role(self, id):
+        return None
+
+
+class FakeMessage:
+    attachments = ()
+
+    def __init__(self, author, content, channel=None):
+        self.author = author
+        self.content = content
+        self.channel = channel or types.SimpleNamespace(id=None, guild=None)
+        self.guild = self.channel.guild
+
+
+fake_guild = FakeGuild(GUILD)
+users = {id: FakeUser(id) for id in USERS}
+channels = {id: FakeChannel(id) for id in (BRIDGE, ROTG)}
+
+# relay message number -> [sends still expected, event set when they have all arrived]
+waiting = {}
+
+def received(content):
+    # relayed messages end in "relay <n>", which survives lowercasing and punctuation stripping
+    *_, tag, n = content.split()
+    if tag == "relay" and int(n) in waiting:
+        left = waiting[int(n)]
+        left[0] -= 1
+        if not left[0]:
+            left[1].set()
+
+async def fake_gpt(text):
+    await asyncio.sleep(random.uniform(*GPT_LATENCY))
+    return text
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def make_config(cg_port):
+    config = types.ModuleType("config")
+    exec(open(os.path.join(HERE, "config_stub.py")).read(), config.__dict__)
+    config.guild_id = GUILD
+    config.cg_url = f"http://127.0.0.1:{cg_port}/"
+    config.rotg_channel = ROTG
+    config.rotg_admin = 0
+    config.gpt_backend = fake_gpt
+    return config
+
+def make_database(listeners):
+    con = sqlite3.connect("the.db")
+    con.executescript(open(os.path.join(HERE, "schema.sql")).read())
+    # the bridge: a channel with a persona from each listener connected to it, the first of whom is talking
+    for i, user in enumerate(USERS[:listeners + 1]):
+        persona = con.execute("INSERT INTO Personas (user, name) VALUES (?, ?) RETURNING id", (user, f"bridge{i}")).fetchone()[0]
+        con.execute("INSERT INTO AnonConnections (a, b) VALUES (?, ?), (?, ?)", (persona, BRIDGE, BRIDGE, persona))
+        if not i:
+            con.execute("INSERT INTO SelectedPersona (user, persona) VALUES (?, ?)", (user, persona))
+            con.execute("INSERT INTO Settings (user, gpt) VALUES (?, 0)", (user,))
+    # a third of everyone else has GPT rewriting on
+    con.executemany("INSERT INTO Settings (user, gpt) VALUES (?, 1)", [(user,) for user in USERS[listeners + 1::3]])
+    con.executemany("INSERT INTO Meows (meow) VALUES (?)", [("meow",), ("mrrp",), ("nya",), ("purr",)])
+    con.commit()
+    con.close()
+
+
+def summarise(latencies, errors, seconds):
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds if seconds else None,
+        "p50": pick(0.5),
+        "p99": pick(0.99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+async def drive(n, concurrency, op):
+    """Run op(0) ... op(n - 1), at most concurrency at once, timing each."""
+    latencies = []
+    errors = 0
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await op(i)
+            except Exception:
+                logging.exception("Operation failed")
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(n)])
+    return summarise(latencies, errors, time.perf_counter() - start)
+
+async def request(client, method, path, **kwargs):
+    async with client.request(method, path, **kwargs) as resp:
+        if resp.status >= 400:
+            raise RuntimeError(f"{method} {path}: {resp.status} {await resp.text()}")
+        await resp.read()
+
+
+async def run(args):
+    import canon
+
+    canon.setup("all")
+    # one line per request would be most of the work, and a loaded server logs a lot of slow calls
+    logging.getLogger().setLevel(logging.WARNING if args.verbose else logging.ERROR)
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    canon.bot.get_user = users.get
+    canon.bot.get_channel = channels.get
+    canon.bot.get_guild = {GUILD: fake_guild}.get
+    listeners = canon.bot.extra_events["on_message"]
+
+    async def dispatch(message):
+        await asyncio.gather(*[f(message) for f in listeners])
+
+    scale = lambda n: max(1, int(n * args.scale))
+    # first-time lookups, until everyone has been seen
+    fresh = itertools.cycle(USERS[args.listeners + 1:])
+    talker = users[USERS[0]]
+
+    async def relay(i):
+        done = asyncio.Event()
+        waiting[i] = [args.listeners + 1, done]
+        await dispatch(FakeMessage(talker, f"Hello, everyone! relay {i}"))
+        await done.wait()
+        del waiting[i]
+
+    everyone = [*users.values()]
+
+    async def meows(i):
+        await dispatch(FakeMessage(random.choice(everyone), random.choice(["meow", "mrrp mrrp", "nothing to see", "nya~ purr meow"]), channels[ROTG]))
+
+    async with TestClient(TestServer(canon.app)) as client:
+        async def personas(i):
+            await request(client, "GET", f"/users/{next(fresh)}/personas")
+
+        async def bulk_users(i):
+            await request(client, "POST", "/users", json={"users": random.sample(USERS, 50), "roles": [1, 2]})
+
+        async def transform(i):
+            user = random.choice(USERS[args.listeners + 1:])
+            persona = (await canon.fetch_personas(user))[0].id
+            await request(client, "POST", f"/users/{user}/transform", json={"text": "Did you see that? It's wild.", "persona": persona})
+
+        async def notify(i):
+            parent, reply = random.sample(USERS[:20], 2)
+            await request(client, "POST", "/notify", json={
+                "parent": parent, "reply": reply, "persona": -1, "user": USERS[-1], "url": f"https://example.com/{i}", "content": "nice",
+            })
+
+        async def cg(i):
+            await request(client, "GET", "/cg")
+
+        scenarios = {
+            "personas": (personas, scale(500), 50),
+            "bulk_users": (bulk_users, scale(100), 10),
+            "transform": (transform, scale(300), 50),
+            "notify": (notify, scale(100), 20),
+            "relay": (relay, scale(20), 5),
+            "meows": (meows, scale(2000), 50),
+            "cg": (cg, scale(500), 50),
+        }
+        results = {}
+        for name, (op, n, concurrency) in scenarios.items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = await drive(n, concurrency, op)
+            # whatever was queued for Discord counts against this scenario, not the next
+            start = time.perf_counter()
+            await canon.outbox.drain(120)
+            results[name]["drain_seconds"] = time.perf_counter() - start
+            print(f"{name:>12}  {results[name]['count']:6} ops  {results[name]['throughput'] or 0:9.1f}/s  "
+                  f"p50 {(results[name]['p50'] or 0) * 1000:8.1f}ms  p99 {(results[name]['p99'] or 0) * 1000:8.1f}ms  "
+                  f"errors {results[name]['errors']}", flush=True)
+    return results
+
+async def main(args):
+    cg_app = web.Application()
+    cg_app.router.add_get("/", lambda request: web.Response(text=CG_PAGE, content_type="text/html", headers={"ETag": '"50"'}))
+    cg_port = free_port()
+    runner = web.AppRunner(cg_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", cg_port).start()
+    try:
+        sys.modules["config"] = make_config(cg_port)
+        make_database(args.listeners)
+        return await run(args)
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark canon.py against local stand-ins.")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the number of operations in each scenario")
+    parser.add_argument("--listeners", type=int, default=15, help="personas listening on the relayed channel")
+    parser.add_argument("--only", type=lambda s: s.split(","), help="comma-separated scenarios to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show canon's warnings, such as slow calls")
+    parser.add_argument("--output", default="bench.json")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip() or None
+    sys.path.insert(0, HERE)
+    os.environ.setdefault("OPENAI_API_KEY", "unused")
+    output = os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        shutil.copy(os.path.join(HERE, "names"), scratch)
+        os.chdir(scratch)
+        results = asyncio.run(main(args))
+        logging.shutdown()
+
+    with open(output, "w") as f:
+        json.dump({"commit": commit, "time": time.time(), "args": vars(args), "scenarios": results}, f, indent=2)
+    print(f"wrote {output}")
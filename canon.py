@@ -1,72 +1,503 @@
 import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import cProfile
 import datetime
+import functools
+import heapq
+import importlib
+import io
+import itertools
+import json
 import logging
+import math
+import os
+import pstats
 import random
 import re
+import signal
+import sqlite3
+import sys
+import threading
 import time
+import traceback
+import types
+import weakref
+
+# everything before this is quick to import; the rest is counted in the startup report
+started = time.perf_counter()
 
 import aiosqlite
 import aiohttp
 import discord
 from aiohttp import web
+from aiosqlite.context import Result
 from discord.ext import commands
-from bs4 import BeautifulSoup
-from openai import AsyncOpenAI
 
 import config
 
+# seconds spent on each part of starting up, for the report logged once the app is ready
+startup_times = {"imports": time.perf_counter() - started}
+
 if config.log_file:
     discord.utils.setup_logging(handler=logging.FileHandler(filename=config.log_file, encoding="utf-8"))
 else:
     discord.utils.setup_logging()
 
 
-openai = AsyncOpenAI()
+# created by the first GPT rewrite
+openai = None
 routes = web.RouteTableDef()
 
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+# (metric, labels) -> Histogram, for /metrics
+latencies = collections.defaultdict(Histogram)
+
+SLOW_THRESHOLD = 1
+# metrics timing a single handler or statement, which should never take long
+SLOW_METRICS = {"canon_http_request_seconds", "canon_command_seconds", "canon_listener_seconds", "canon_sql_seconds"}
+
+def observe(metric, seconds, **labels):
+    latencies[metric, tuple(labels.items())].observe(seconds)
+    if seconds > SLOW_THRESHOLD and metric in SLOW_METRICS:
+        logging.warning("Slow %s %s took %.2fs", metric, labels, seconds)
+
+@contextlib.contextmanager
+def timed(metric, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(metric, time.perf_counter() - start, **labels)
+
+def timed_handler(metric, **labels):
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            with timed(metric, **labels):
+                return await f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@functools.cache
+def sql_label(sql):
+    # IN lists are built to fit their arguments, but should all count as one statement
+    return re.sub(r"IN \(\?(, \?)*\)", "IN (...)", " ".join(sql.split()))
+
+def time_statements(conn):
+    def wrap(run):
+        def wrapper(sql, *args):
+            async def timed_run():
+                with timed("canon_sql_seconds", statement=sql_label(sql)):
+                    return await run(sql, *args)
+            return Result(timed_run())
+        return wrapper
+    conn.execute = wrap(conn.execute)
+    conn.executemany = wrap(conn.executemany)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+def render_metrics():
+    # workers share a port, so any of them may answer a scrape; each has its own series
+    process = (("mode", mode), ("pid", os.getpid()))
+    lines = []
+    families = collections.defaultdict(dict)
+    for (metric, labels), histogram in latencies.items():
+        families[metric][labels] = histogram
+    for metric, series in families.items():
+        lines.append(f"# TYPE {metric} histogram")
+        for labels, histogram in series.items():
+            total = 0
+            for bound, n in zip((*LATENCY_BUCKETS, "+Inf"), histogram.counts):
+                total += n
+                lines.append(f"{metric}_bucket{format_labels((*process, *labels, ("le", bound)))} {total}")
+            lines.append(f"{metric}_sum{format_labels((*process, *labels))} {histogram.sum}")
+            lines.append(f"{metric}_count{format_labels((*process, *labels))} {total}")
+    lines.append("# TYPE canon_outbox_messages_total counter")
+    for (route, outcome), n in outbox.stats.items():
+        if outcome != "seconds":
+            lines.append(f"canon_outbox_messages_total{format_labels((*process, ("route", route), ("outcome", outcome)))} {n}")
+    lines.append("# TYPE canon_outbox_waiting gauge")
+    lines.append(f"canon_outbox_waiting{format_labels(process)} {sum(map(len, outbox.queues.values()))}")
+    lines.append("# TYPE canon_startup_seconds gauge")
+    for phase, t in startup_times.items():
+        lines.append(f"canon_startup_seconds{format_labels((*process, ("phase", phase)))} {t}")
+    return "\n".join(lines) + "\n"
+
+@routes.get("/metrics")
+async def metrics(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+@web.middleware
+async def time_requests(request, handler):
+    resource = request.match_info.route.resource
+    if resource and resource.canonical in UNTIMED_ROUTES:
+        return await handler(request)
+    with timed("canon_http_request_seconds", route=f"{request.method} {resource.canonical if resource else 'unmatched'}"):
+        return await handler(request)
+
+# routes that stay open for a long time on purpose
+UNTIMED_ROUTES = {"/events", "/debug/profile"}
+
+LAG_INTERVAL = 0.5
+
+async def loop_monitor(_):
+    # a thread watches for the loop going quiet, and says what it was stuck on
+    loop = asyncio.get_running_loop()
+    loop_thread = threading.get_ident()
+    heartbeat = time.monotonic()
+    stopping = threading.Event()
+
+    def watch():
+        reported = None
+        while not stopping.wait(LAG_INTERVAL / 5):
+            if time.monotonic() - heartbeat > LAG_INTERVAL + SLOW_THRESHOLD and reported != heartbeat:
+                reported = heartbeat
+                if frame := sys._current_frames().get(loop_thread):
+                    logging.warning("Event loop blocked for over %.2fs in:\n%s", time.monotonic() - heartbeat, "".join(traceback.format_stack(frame)))
+
+    async def sample():
+        nonlocal heartbeat
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            heartbeat = time.monotonic()
+            observe("canon_loop_lag_seconds", max(0, loop.time() - start - LAG_INTERVAL))
+
+    watcher = threading.Thread(target=watch, name="loop-watchdog", daemon=True)
+    watcher.start()
+    task = asyncio.create_task(sample())
+    yield
+    task.cancel()
+    stopping.set()
+
+def check_admin(request):
+    if not config.admin_token or request.headers.get("Authorization") != f"Bearer {config.admin_token}":
+        raise web.HTTPForbidden()
+
+profiling = asyncio.Lock()
+
+@routes.post("/debug/profile")
+async def profile(request):
+    check_admin(request)
+    if profiling.locked():
+        raise web.HTTPConflict(text="A profile is already being taken.")
+    try:
+        seconds = float(request.query.get("seconds", 10))
+    except ValueError:
+        seconds = math.nan
+    if not 0 < seconds < math.inf:
+        raise web.HTTPBadRequest(text="seconds must be a positive number.")
+    seconds = min(seconds, 60)
+    async with profiling:
+        # everything on the loop runs in this thread, so this sees all of it
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    out = io.StringIO()
+    # in a split deployment this is only the worker that happened to get the request
+    out.write(f"{mode} process {os.getpid()}\n")
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(50)
+    return web.Response(text=out.getvalue())
+
+# "all" runs everything in one process. Otherwise there is one "gateway" process, which talks to Discord and runs
+# the bot, and any number of "api" workers serving HTTP on the same port; see __main__
+mode = "all"
+
+# the other processes: the gateway's connections to each worker, or a worker's one connection to the gateway
+peers = []
+# functions other processes can ask this one to run, by name
+remote_ops = {}
+# those of them that keep state every process has in step, which the gateway passes on to the other workers
+shared_ops = set()
+
+def ipc_message(op, *args):
+    return (json.dumps([op, args]) + "\n").encode()
+
+def tell(op, *args, skip=None):
+    if not peers:
+        return
+    message = ipc_message(op, *args)
+    for writer in peers:
+        if writer is not skip:
+            writer.write(message)
+
+def remote(f):
+    remote_ops[f.__name__] = f
+    return f
+
+def shared(f):
+    """Make calls to f happen in every process of a split deployment, not just this one."""
+    remote(f)
+    shared_ops.add(f.__name__)
+    @functools.wraps(f)
+    def wrapper(*args):
+        f(*args)
+        tell(f.__name__, *args)
+    return wrapper
+
+# all writes go through transaction(), which runs them under a savepoint of one shared transaction
+# that is committed by the first group_commit() after they finish
+write_lock = asyncio.Lock()
+pending_commit = None
+
+@contextlib.asynccontextmanager
+async def transaction():
+    async with write_lock:
+        if not db.in_transaction:
+            await db.execute("BEGIN IMMEDIATE")
+        await db.execute("SAVEPOINT work")
+        token = writing.set(True)
+        try:
+            yield
+        except BaseException:
+            await db.execute("ROLLBACK TO work")
+            await db.execute("RELEASE work")
+            # with no commit on the way for anyone else's work, the transaction would hold SQLite's write lock indefinitely
+            if not pending_commit:
+                await db.rollback()
+            raise
+        else:
+            await db.execute("RELEASE work")
+        finally:
+            writing.reset(token)
+    await commit()
+
+async def commit():
+    global pending_commit
+    if not pending_commit:
+        pending_commit = asyncio.create_task(group_commit())
+    await asyncio.shield(pending_commit)
+
+async def group_commit():
+    global pending_commit
+    # let every writer that is ready this tick join in
+    await asyncio.sleep(0)
+    async with write_lock:
+        pending_commit = None
+        with timed("canon_sql_seconds", statement="COMMIT"):
+            await db.commit()
+
+READERS = 4
+
+# read-only connections, so that reads don't queue behind writes on db's thread
+# WAL lets them read the last commit while a transaction is open
+readers = asyncio.Queue()
+# set while inside transaction(), whose uncommitted writes only db can see
+writing = contextvars.ContextVar("writing", default=False)
+
+@contextlib.asynccontextmanager
+async def reading():
+    if writing.get():
+        yield db
+        return
+    reader = await readers.get()
+    try:
+        yield reader
+    finally:
+        readers.put_nowait(reader)
+
+async def open_reader():
+    reader = await aiosqlite.connect("file:the.db?mode=ro", uri=True, isolation_level=None)
+    reader.row_factory = aiosqlite.Row
+    time_statements(reader)
+    return reader
+
 with open("names") as f:
-    NAMES = f.read().splitlines()
+    NAMES = frozenset(f.read().splitlines())
+
+# toki pona names not held by any active persona, filled in database()
+# kept as a list for random.choice, with each name's position so it can be removed in O(1)
+free_names = []
+free_name_index = {}
+
+@shared
+def free_name(name):
+    if name in NAMES and name not in free_name_index and name not in personas_by_name:
+        free_name_index[name] = len(free_names)
+        free_names.append(name)
+
+@shared
+def take_name(name):
+    if (i := free_name_index.pop(name, None)) is not None:
+        last = free_names.pop()
+        if i < len(free_names):
+            free_names[i] = last
+            free_name_index[last] = i
+
+def rand_name():
+    if not free_names:
+        raise RuntimeError("All toki pona names are taken.")
+    name = random.choice(free_names)
+    take_name(name)
+    return name
 
-async def rand_name():
-    while True:
-        name = random.choice(NAMES)
-        if not await conflicts(name):
-            return name
+async def load_names():
+    free_names[:] = NAMES - personas_by_name.keys()
+    free_name_index.update((name, i) for i, name in enumerate(free_names))
 
 async def conflicts(name):
-    async with db.execute("SELECT EXISTS(SELECT 1 FROM Personas WHERE active AND name = ?)", (name,)) as cur:
-        r, = await cur.fetchone()
-    return r
+    return name in personas_by_name
+
+class MemberMirror(discord.Object):
+    def __init__(self, id, roles):
+        super().__init__(id)
+        self.roles = roles
+
+    def get_role(self, id):
+        return id in self.roles
+
+class GuildMirror:
+    """An API worker's copy of the members of the guild and their roles, kept up to date by the gateway."""
+
+    def __init__(self, members):
+        self.members = {user: set(roles) for user, roles in members}
+
+    def get_member(self, id):
+        if (roles := self.members.get(id)) is not None:
+            return MemberMirror(id, roles)
+
+    def get_role(self, id):
+        return types.SimpleNamespace(members=[MemberMirror(user, roles) for user, roles in self.members.items() if id in roles])
+
+guild_mirror = None
+
+@remote
+def mirror_guild(members):
+    global guild_mirror
+    guild_mirror = GuildMirror(members) if members is not None else None
+
+@remote
+def mirror_member(user, roles):
+    if not guild_mirror:
+        return
+    if roles is None:
+        guild_mirror.members.pop(user, None)
+    else:
+        guild_mirror.members[user] = set(roles)
+
+def guild_snapshot():
+    if guild := bot.get_guild(config.guild_id):
+        return [(member.id, [role.id for role in member.roles]) for member in guild.members]
+
+def the_guild():
+    return guild_mirror if mode == "api" else bot.get_guild(config.guild_id)
+
+def get_user(id):
+    # API workers can't see Discord, so they refer to users by id and let the gateway look them up when sending
+    return discord.Object(id) if mode == "api" else bot.get_user(id)
+
+def member_can_play(guild, user):
+    if guild:
+        return bool(guild.get_member(user))
+    return not config.guild_id
+
+def member_has_role(guild, user, role):
+    return bool(guild and (member := guild.get_member(user)) and member.get_role(role))
 
 @routes.get(r"/users/{user:\d+}")
 async def can_play(request):
     user = int(request.match_info["user"])
-    if guild := bot.get_guild(config.guild_id):
-        can_play = bool(guild.get_member(user))
-    else:
-        can_play = not config.guild_id
-    return web.json_response({"can_play": can_play})
+    return web.json_response({"can_play": member_can_play(the_guild(), user)})
 
 @routes.get(r"/users/{user:\d+}/roles/{role:\d+}")
 async def has_role(request):
     user = int(request.match_info["user"])
     role = int(request.match_info["role"])
-    return web.json_response(bool((guild := bot.get_guild(config.guild_id)) and (member := guild.get_member(user)) and member.get_role(role)))
+    return web.json_response(member_has_role(the_guild(), user, role))
+
+NAME_ATTEMPTS = 5
+
+async def fetch_many_personas(users):
+    users = [*dict.fromkeys(users)]
+    if missing := [user for user in users if not any(p.toki_pona for p in personas_by_user.get(user, {}).values())]:
+        # workers draw from their own copies of the pool, so two can pick the same name before hearing of each other's;
+        # the loser's row is ignored and it draws again
+        for _ in range(NAME_ATTEMPTS):
+            drawn = []
+            try:
+                for user in missing:
+                    drawn.append((user, rand_name()))
+                async with transaction():
+                    await db.executemany(
+                        "INSERT OR IGNORE INTO Personas (user, name, temp, toki_pona, last_used) SELECT ?, ?, 1, 1, COALESCE(MAX(last_used), 0) FROM"
+                        " (SELECT last_used FROM Personas WHERE toki_pona AND user = ?1 UNION ALL SELECT last_used FROM ArchivedPersonas WHERE toki_pona AND user = ?1)",
+                        drawn,
+                    )
+                    async with db.execute(f"SELECT * FROM Personas WHERE active AND toki_pona AND user IN ({", ".join("?" * len(missing))})", missing) as cur:
+                        created = await cur.fetchall()
+            except BaseException:
+                # nothing was inserted, so the names go back in the pool, unless someone else holds them
+                names = json.dumps([name for _, name in drawn])
+                async with reading() as reader, reader.execute("SELECT name FROM Personas WHERE active AND name IN (SELECT value FROM json_each(?))", (names,)) as cur:
+                    held = {name for name, in await cur.fetchall()}
+                for _, name in drawn:
+                    if name not in held:
+                        free_name(name)
+                raise
+            for row in created:
+                register(dict(row))
+                # another worker may have made this user's persona at the same time, and announced it itself
+                if (row["user"], row["name"]) in drawn:
+                    publish("persona_create", id=row["id"], user=row["user"], name=row["name"], temp=bool(row["temp"]))
+            # the names of those left over are held elsewhere, so they stay out of the pool
+            if not (missing := [user for user in missing if not any(p.toki_pona for p in personas_by_user.get(user, {}).values())]):
+                break
+        else:
+            raise RuntimeError("Couldn't find free toki pona names.")
+
+    return {user: sorted(personas_by_user.get(user, {}).values(), key=lambda p: p.last_used, reverse=True) for user in users}
 
 async def fetch_personas(user):
-    async with db.execute("SELECT EXISTS(SELECT 1 FROM Personas WHERE active AND toki_pona AND user = ?)", (user,)) as cur:
-        has_toki_pona, = await cur.fetchone()
-    if not has_toki_pona:
-        await db.execute("INSERT INTO Personas (user, name, temp, toki_pona, last_used) SELECT ?, ?, 1, 1, COALESCE(MAX(last_used), 0) FROM Personas WHERE toki_pona AND user = ?1", (user, await rand_name()))
-        await db.commit()
+    return (await fetch_many_personas([user]))[user]
 
-    async with db.execute("SELECT * FROM Personas WHERE active AND user = ? ORDER BY last_used DESC", (user,)) as cur:
-        return [Persona(row) for row in await cur.fetchall()]
+def persona_json(p):
+    return {"id": p.id, "name": p.name, "temp": p.temp}
 
 @routes.get(r"/users/{user:\d+}/personas")
 async def get_personas(request):
     user = int(request.match_info["user"])
-    return web.json_response([{"id": p.id, "name": p.name, "temp": p.temp} for p in await fetch_personas(user)])
+    return web.json_response([persona_json(p) for p in await fetch_personas(user)])
+
+@routes.post("/users")
+async def get_users(request):
+    json = await request.json()
+    try:
+        users = [int(user) for user in json["users"]]
+        roles = [int(role) for role in json.get("roles", [])]
+    except (KeyError, TypeError, ValueError):
+        raise web.HTTPBadRequest(text="Expected a list of user ids and optionally one of role ids.")
+    guild = the_guild()
+    personas = await fetch_many_personas(users)
+    return web.json_response({
+        user: {
+            "can_play": member_can_play(guild, user),
+            "roles": {role: member_has_role(guild, user, role) for role in roles},
+            "personas": [persona_json(p) for p in personas[user]],
+        }
+        for user in users
+    })
 
 async def parse_user_obj(json):
     name = json["name"].strip()
@@ -88,31 +519,106 @@ async def add_persona(request):
     if not name:
         return web.json_response({"result": "taken"}, status=403)
 
-    async with db.execute("INSERT INTO Personas (user, name, temp) VALUES (?, ?, ?) RETURNING id", (user, name, json.get("temp", False))) as cur:
-        id, = await cur.fetchone()
-    await db.commit()
+    try:
+        async with transaction(), db.execute("INSERT INTO Personas (user, name, temp) VALUES (?, ?, ?) RETURNING *", (user, name, json.get("temp", False))) as cur:
+            row = dict(await cur.fetchone())
+    except sqlite3.IntegrityError:
+        return web.json_response({"result": "taken"}, status=403)
+    id = row["id"]
+    register(row)
+    take_name(name)
+    publish("persona_create", id=id, user=user, name=name, temp=bool(json.get("temp", False)))
     return web.json_response({"result": "success", "id": id})
 
+SETTINGS_CACHE_SIZE = 4096
+
+# least recently used Settings rows, written through by emplace_settings
+settings_cache = collections.OrderedDict()
+# column defaults from the schema, for users without a row; filled in database()
+settings_defaults = {}
+
+def cache_settings(user, s):
+    settings_cache[user] = s
+    settings_cache.move_to_end(user)
+    if len(settings_cache) > SETTINGS_CACHE_SIZE:
+        settings_cache.popitem(last=False)
+
 async def fetch_settings(user):
-    async with db.execute("SELECT * FROM Settings WHERE user = ?", (user,)) as cur:
-        if r := await cur.fetchone():
-            return dict(r)
-    async with db.execute("INSERT OR IGNORE INTO Settings (user) VALUES (?) RETURNING *", (user,)) as cur:
-        return dict(await cur.fetchone())
+    if (s := settings_cache.get(user)) is not None:
+        settings_cache.move_to_end(user)
+        return s
+    async with reading() as reader, reader.execute("SELECT * FROM Settings WHERE user = ?", (user,)) as cur:
+        r = await cur.fetchone()
+    # emplace_settings may have cached a newer row while we were waiting
+    if user not in settings_cache:
+        cache_settings(user, dict(r) if r else {"user": user, **settings_defaults})
+    return settings_cache[user]
+
+ACTIVE_WINDOW = 35*24*60*60
+IDENTIFYING_SETTINGS = ["gpt", "lowercase", "punctuation", "dms", "persona_dms"]
+
+# how many recently active users have each value of each setting
+spread = {name: collections.Counter() for name in IDENTIFYING_SETTINGS}
+# the settings each active user is counted in spread with, and when they were last active
+counted = {}
+last_active = {}
+# (last active, user) for every counted user, soonest to expire first
+expiry = []
+
+def count_user(s, n):
+    for name in IDENTIFYING_SETTINGS:
+        spread[name][s[name]] += n
+
+@shared
+def saw_user(user, when, s):
+    if user not in counted:
+        counted[user] = s
+        count_user(s, 1)
+        heapq.heappush(expiry, (when, user))
+    last_active[user] = max(when, last_active.get(user, 0))
+
+def recount_user(user, s):
+    if user in counted:
+        count_user(counted[user], -1)
+        counted[user] = s
+        count_user(s, 1)
+
+@shared
+def settings_changed(user, s):
+    cache_settings(user, s)
+    recount_user(user, s)
+
+def expire_users():
+    cutoff = time.time() - ACTIVE_WINDOW
+    while expiry and expiry[0][0] <= cutoff:
+        when, user = heapq.heappop(expiry)
+        if last_active[user] > when:
+            heapq.heappush(expiry, (last_active[user], user))
+        else:
+            del last_active[user]
+            count_user(counted.pop(user), -1)
+
+async def load_activity():
+    async with db.execute(
+        "SELECT user, MAX(last_used) FROM (SELECT user, last_used FROM Personas UNION ALL SELECT user, last_used FROM ArchivedPersonas) GROUP BY user HAVING MAX(last_used) > ?",
+        (time.time() - ACTIVE_WINDOW,),
+    ) as cur:
+        rows = await cur.fetchall()
+    # one query for everyone's settings rather than one each
+    async with db.execute("SELECT * FROM Settings WHERE user IN (SELECT value FROM json_each(?))", (json.dumps([user for user, _ in rows]),)) as cur:
+        settings = {r["user"]: dict(r) for r in await cur.fetchall()}
+    for user, when in rows:
+        s = settings.get(user) or {"user": user, **settings_defaults}
+        cache_settings(user, s)
+        saw_user(user, when, s)
 
 async def fetch_entropy(user):
-    async with db.execute("""
-      SELECT
-        -log2(AVG(our_settings.gpt = their_settings.gpt)) +
-        -log2(AVG(our_settings.lowercase = their_settings.lowercase)) +
-        -log2(AVG(our_settings.punctuation = their_settings.punctuation)) +
-        -log2(AVG(our_settings.dms = their_settings.dms)) +
-        -log2(AVG(our_settings.persona_dms = their_settings.persona_dms))
-      FROM Settings AS our_settings, Settings as their_settings
-      WHERE our_settings.user = ? AND EXISTS(SELECT 1 FROM Personas WHERE user = their_settings.user and last_used > ?)
-    """, (user, time.time() - 35*24*60*60)) as cur:
-        entropy, = await cur.fetchone()
-    return entropy or 0
+    expire_users()
+    s = await fetch_settings(user)
+    shares = [spread[name][s[name]] for name in IDENTIFYING_SETTINGS]
+    if not all(shares):
+        return 0
+    return -sum(math.log2(n / len(counted)) for n in shares)
 
 blurbs = [
     {
@@ -160,11 +666,12 @@ async def settings(request):
     return web.json_response({"settings": [{"value": s[d["name"]], **d} for d in blurbs], "entropy": entropy})
 
 async def emplace_settings(user, s):
-    await db.execute(
-        "INSERT OR REPLACE INTO Settings (user, gpt, lowercase, punctuation, notify_comments, notify_replies, dms, persona_dms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (user, "gpt" in s, "lowercase" in s, "punctuation" in s, "notify_comments" in s, "notify_replies" in s, "dms" in s, "persona_dms" in s),
-    )
-    await db.commit()
+    async with transaction():
+        await db.execute(
+            "INSERT OR REPLACE INTO Settings (user, gpt, lowercase, punctuation, notify_comments, notify_replies, dms, persona_dms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user, "gpt" in s, "lowercase" in s, "punctuation" in s, "notify_comments" in s, "notify_replies" in s, "dms" in s, "persona_dms" in s),
+        )
+    settings_changed(user, {"user": user, **{name: int(name in s) for name in settings_defaults}})
 
 @routes.post(r"/users/{user:\d+}/settings")
 async def set_settings(request):
@@ -173,37 +680,250 @@ async def set_settings(request):
     await emplace_settings(user, settings)
     return web.Response(status=204)
 
-async def transform_text(text, persona, user_id):
-    settings = await fetch_settings(user_id)
-
-    await db.execute("UPDATE Personas SET last_used = ? WHERE id = ?", (time.time(), persona))
-    await db.commit()
-
+GPT_ATTEMPTS = 3
+gpt_slots = asyncio.Semaphore(config.gpt_concurrency)
+
+async def openai_rewrite(text):
+    global openai
+    if not openai:
+        # importing openai takes about a second, so it's put off until it's needed and kept off the event loop
+        module = await asyncio.to_thread(importlib.import_module, "openai")
+        # retries are done by gpt_rewrite, within its deadline
+        openai = openai or module.AsyncOpenAI(max_retries=0)
+    completion = await openai.chat.completions.create(
+        model="gpt-4.1",
+        messages=[
+            {"role": "system", "content": """As a bot that helps people remain anonymous, you rewrite messages to sound more generic. Your responses should always have the same meaning, perspective and similar tone to the original message, but with different wording and grammar. Please take care to preserve the meaning of programming- and computer-related terms. "code guessing" is a proper noun and should never be changed. Discord markup should also be left alone."""},
+            {"role": "user", "content": text},
+        ],
+    )
+    return completion.choices[0].message.content
+
+def retryable(e):
+    if isinstance(e, (TimeoutError, ConnectionError, aiohttp.ClientConnectionError)):
+        return True
+    # openai is only imported once it has been used, and if it hasn't been it can't have raised
+    if (module := sys.modules.get("openai")) and isinstance(e, module.APIConnectionError):
+        return True
+    status = getattr(e, "status_code", None) or getattr(e, "status", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+async def gpt_rewrite(text):
+    rewrite = config.gpt_backend or openai_rewrite
+    # the deadline covers waiting for a slot as well as every attempt
+    async with asyncio.timeout(config.gpt_timeout):
+        for attempt in range(GPT_ATTEMPTS):
+            try:
+                # the slot is given up while backing off, so someone else can use it
+                async with gpt_slots:
+                    with timed("canon_gpt_seconds"):
+                        return await rewrite(text)
+            except Exception as e:
+                if attempt == GPT_ATTEMPTS - 1 or not retryable(e):
+                    raise
+                logging.warning("GPT rewrite failed, retrying", exc_info=True)
+            await asyncio.sleep(2**attempt)
+
+async def rewrite_text(text, settings):
     if text.startswith("\\"):
         text = text[1:]
     else:
+        lowercase = settings["lowercase"]
+        punctuation = settings["punctuation"]
         if settings["gpt"]:
-            completion = await openai.chat.completions.create(
-                model="gpt-4.1",
-                messages=[
-                    {"role": "system", "content": """As a bot that helps people remain anonymous, you rewrite messages to sound more generic. Your responses should always have the same meaning, perspective and similar tone to the original message, but with different wording and grammar. Please take care to preserve the meaning of programming- and computer-related terms. "code guessing" is a proper noun and should never be changed. Discord markup should also be left alone."""},
-                    {"role": "user", "content": text},
-                ],
-            )
-            text = completion.choices[0].message.content
-        if settings["lowercase"]:
+            try:
+                text = await gpt_rewrite(text)
+            except Exception:
+                if not config.gpt_fallback:
+                    raise
+                # sending the text as written would give away more than the user asked for
+                logging.exception("GPT rewrite failed, normalising instead")
+                lowercase = punctuation = True
+        if lowercase:
             text = text.lower()
-        if settings["punctuation"]:
+        if punctuation:
             text = text.replace(",", "").replace("'", "").replace(".", "").replace("?", "")
 
     return text
 
+async def transform_text(text, persona, user_id):
+    settings = await fetch_settings(user_id)
+
+    now = time.time()
+    async with transaction():
+        await db.execute("UPDATE Personas SET last_used = ? WHERE id = ?", (now, persona))
+    touch([persona], now)
+    saw_user(user_id, now, settings)
+
+    return await rewrite_text(text, settings)
+
 @routes.post(r"/users/{user:\d+}/transform")
 async def transform(request):
     user = int(request.match_info["user"])
     json = await request.json()
     return web.json_response({"text": await transform_text(json["text"], json["persona"], user)})
 
+@routes.post("/transform/batch")
+async def transform_batch(request):
+    items = await request.json()
+    if not isinstance(items, list):
+        raise web.HTTPBadRequest(text="Expected a list of items.")
+    results = [None] * len(items)
+    good = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"error": "Items must be objects."}
+        elif missing := [key for key in ("user", "persona", "text") if key not in item]:
+            results[i] = {"error": f"Missing {", ".join(missing)}."}
+        elif not isinstance(item["user"], int) or not isinstance(item["persona"], int) or not isinstance(item["text"], str):
+            results[i] = {"error": "user and persona must be ids and text a string."}
+        else:
+            good[i] = item
+
+    settings = {}
+    for item in good.values():
+        if item["user"] not in settings:
+            settings[item["user"]] = await fetch_settings(item["user"])
+
+    now = time.time()
+    used = [*{item["persona"] for item in good.values()}]
+    async with transaction():
+        await db.executemany("UPDATE Personas SET last_used = ? WHERE id = ?", [(now, persona) for persona in used])
+    touch(used, now)
+    for user, s in settings.items():
+        saw_user(user, now, s)
+
+    rewritten = await asyncio.gather(*[rewrite_text(item["text"], settings[item["user"]]) for item in good.values()], return_exceptions=True)
+    for i, r in zip(good, rewritten):
+        results[i] = {"error": str(r) or type(r).__name__} if isinstance(r, Exception) else {"text": r}
+    return web.json_response(results)
+
+OUTBOX_RATE = 40
+OUTBOX_ROUTE_RATES = {"relay": 30, "notify": 10, "round-over": 10, "hangup": 10}
+OUTBOX_CONCURRENCY = 8
+OUTBOX_ATTEMPTS = 5
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Letter:
+    __slots__ = ("destination", "content", "attachments", "route", "digest", "queued")
+
+    def __init__(self, destination, content, attachments, route, digest):
+        self.destination = destination
+        self.content = content
+        self.attachments = attachments
+        self.route = route
+        self.digest = digest
+        self.queued = time.monotonic()
+
+class Outbox:
+    """Sends messages in the background, in order per destination, within Discord's rate limits."""
+
+    def __init__(self):
+        # destination id -> letters waiting for it, and the task sending them
+        self.queues = {}
+        self.workers = {}
+        self.slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self.bucket = TokenBucket(OUTBOX_RATE)
+        self.route_buckets = {route: TokenBucket(rate) for route, rate in OUTBOX_ROUTE_RATES.items()}
+        self.stats = collections.Counter()
+
+    def send(self, destination, content, *, route, attachments=(), digest=False):
+        """Queue a message. Messages sent with digest=True may be merged with others to the same place."""
+        self.queues.setdefault(destination.id, collections.deque()).append(Letter(destination, content, attachments, route, digest))
+        self.stats[route, "queued"] += 1
+        if destination.id not in self.workers:
+            self.workers[destination.id] = asyncio.create_task(self.work(destination.id))
+
+    async def work(self, key):
+        queue = self.queues[key]
+        try:
+            while queue:
+                letter = queue.popleft()
+                if letter.digest and config.notify_digest_window:
+                    await asyncio.sleep(letter.queued + config.notify_digest_window - time.monotonic())
+                    # only merge the letters directly after this one, so nothing is sent out of order
+                    while queue and queue[0].digest and len(letter.content) + len(queue[0].content) + 2 <= 2000:
+                        letter.content += "\n\n" + queue.popleft().content
+                        self.stats[letter.route, "coalesced"] += 1
+                await self.deliver(letter)
+        finally:
+            del self.queues[key], self.workers[key]
+
+    async def deliver(self, letter):
+        for attempt in range(OUTBOX_ATTEMPTS):
+            await self.bucket.take()
+            await self.route_buckets[letter.route].take()
+            try:
+                async with self.slots:
+                    with timed("canon_discord_send_seconds", route=letter.route):
+                        await letter.destination.send(letter.content, files=[
+                            discord.File(io.BytesIO(data), filename=f.filename, description=f.description, spoiler=f.is_spoiler())
+                            for f, data in letter.attachments
+                        ])
+            except discord.HTTPException as e:
+                if (e.status == 429 or e.status >= 500) and attempt < OUTBOX_ATTEMPTS - 1:
+                    self.stats[letter.route, "retried"] += 1
+                    await asyncio.sleep(min(2**attempt, 60))
+                    continue
+                logging.exception("Failed to send %s message to %s", letter.route, letter.destination)
+            except Exception:
+                logging.exception("Failed to send %s message to %s", letter.route, letter.destination)
+            else:
+                self.stats[letter.route, "sent"] += 1
+                self.stats[letter.route, "seconds"] += time.monotonic() - letter.queued
+                observe("canon_outbox_delivery_seconds", time.monotonic() - letter.queued, route=letter.route)
+                return
+            self.stats[letter.route, "failed"] += 1
+            return
+
+    async def drain(self, timeout):
+        if self.workers:
+            await asyncio.wait([*self.workers.values()], timeout=timeout)
+
+outbox = Outbox()
+
+class ForwardingOutbox(Outbox):
+    """An API worker's outbox, which hands every message to the gateway to send."""
+
+    def send(self, destination, content, *, route, attachments=(), digest=False):
+        # only the gateway relays messages, so workers never have attachments to send
+        tell("send_for", destination.id, content, route, digest)
+        self.stats[route, "forwarded"] += 1
+
+@remote
+def send_for(id, content, route, digest):
+    # someone who has left every server the bot is on can't be messaged, as when sending directly
+    if destination := bot.get_channel(id) or bot.get_user(id):
+        outbox.send(destination, content, route=route, digest=digest)
+
+@routes.get("/outbox")
+async def outbox_stats(request):
+    stats = {}
+    for (route, stat), n in outbox.stats.items():
+        stats.setdefault(route, {})[stat] = n
+    return web.json_response({
+        "mode": mode,
+        "pid": os.getpid(),
+        "waiting": sum(map(len, outbox.queues.values())),
+        "destinations": len(outbox.queues),
+        "routes": stats,
+    })
+
 @routes.post("/notify")
 async def notify(request):
     json = await request.json()
@@ -220,26 +940,26 @@ async def notify(request):
     if (await fetch_settings(reply))["notify_replies"]:
         messages[reply] = "replied to your comment"
     for k, v in messages.items():
-        if k != user and (obj := bot.get_user(k)):
-            asyncio.create_task(obj.send(f"{name} {v} at <{url}>:\n{content}"))
+        if k != user and (obj := get_user(k)):
+            outbox.send(obj, f"{name} {v} at <{url}>:\n{content}", route="notify", digest=True)
     return web.Response(status=204)
 
 def our_staff():
     if isinstance(config.admin_ids, list):
         return config.admin_ids
-    return [x.id for x in bot.get_guild(config.guild_id).get_role(config.admin_ids).members]
+    return [x.id for x in the_guild().get_role(config.admin_ids).members]
 
 @routes.post("/round-over")
 async def round_over(request):
     targets = await request.json()
 
-    if guild := bot.get_guild(config.guild_id):
+    if guild := the_guild():
         if isinstance(targets, int):
             targets = [x.id for x in guild.get_role(targets).members]
 
         for admin_id in targets:
             if admin := guild.get_member(admin_id):
-                asyncio.create_task(admin.send("everyone has finished guessing"))
+                outbox.send(admin, "everyone has finished guessing", route="round-over")
 
     return web.Response(status=204)
 
@@ -248,11 +968,29 @@ async def get_persona(request):
     persona = int(request.match_info["persona"])
     return web.json_response({"name": (await get_persona(persona)).name})
 
+async def deactivate_personas(where, params=()):
+    async with transaction():
+        async with db.execute(f"UPDATE Personas SET active = 0 WHERE active AND {where} RETURNING id, name", params) as cur:
+            gone = dict(await cur.fetchall())
+        ids = json.dumps([*gone])
+        await db.execute("DELETE FROM AnonConnections WHERE a IN (SELECT value FROM json_each(?1)) OR b IN (SELECT value FROM json_each(?1))", (ids,))
+        await db.execute("DELETE FROM SelectedPersona WHERE persona IN (SELECT value FROM json_each(?))", (ids,))
+
+    hung_up = []
+    for persona, name in gone.items():
+        hung_up.extend((name, peer) for peer in links.get(persona, ()) if peer not in gone)
+        unlink(persona)
+        retire(persona)
+        free_name(name)
+        publish("persona_deactivate", id=persona)
+    for name, peer in hung_up:
+        # personas whose owner has left the bot's servers have nobody to tell
+        if (victim := await get_target(peer)) and (to := getattr(victim, "user", victim)):
+            outbox.send(to, f"{name} disconnected.", route="hangup", digest=True)
+    return [*gone]
+
 async def un_persona(persona):
-    await db.execute("UPDATE Personas SET active = 0 WHERE id = ?", (persona,))
-    await db.execute("DELETE FROM AnonConnections WHERE a = ?1 OR b = ?1", (persona,))
-    await db.execute("DELETE FROM SelectedPersona WHERE persona = ?", (persona,))
-    await db.commit()
+    await deactivate_personas("id = ?", (persona,))
 
 @routes.delete(r"/personas/{persona:\d+}")
 async def disable_persona(request):
@@ -262,19 +1000,195 @@ async def disable_persona(request):
 @routes.patch(r"/personas/{persona:\d+}")
 async def edit_persona(request):
     json = await request.json()
+    persona = int(request.match_info["persona"])
     name = await parse_user_obj(json)
     if not name:
         return web.json_response({"result": "taken"}, status=403)
-    await db.execute("UPDATE Personas SET name = ? WHERE id = ?", (name, id))
-    await db.commit()
+    old = await get_persona(persona)
+    try:
+        async with transaction():
+            await db.execute("UPDATE Personas SET name = ? WHERE id = ?", (name, persona))
+            await db.execute("UPDATE ArchivedPersonas SET name = ? WHERE id = ?", (name, persona))
+    except sqlite3.IntegrityError:
+        return web.json_response({"result": "taken"}, status=403)
+    if old and old.active:
+        free_name(old.name)
+        take_name(name)
+        publish("persona_rename", id=persona, name=name)
+    rename(persona, name)
     return web.json_response({"result": "success"})
 
 @routes.post("/personas/purge")
 async def clear_temp_personas(request):
-    async with db.execute("SELECT id FROM Personas WHERE active AND temp") as cur:
-        async for persona, in cur:
-            await un_persona(persona)
-    return web.Response(status=204)
+    return web.json_response({"purged": await deactivate_personas("temp")})
+
+MAINTENANCE_INTERVAL = 24*60*60
+# rows moved to ArchivedPersonas per transaction, so other writes don't wait long behind the move
+ARCHIVE_BATCH = 500
+
+maintaining = asyncio.Lock()
+
+async def archive_personas():
+    archived = 0
+    while True:
+        async with transaction():
+            async with db.execute(f"DELETE FROM Personas WHERE id IN (SELECT id FROM Personas WHERE NOT active LIMIT {ARCHIVE_BATCH}) RETURNING id, user, name, temp, toki_pona, last_used") as cur:
+                rows = await cur.fetchall()
+            await db.executemany("INSERT INTO ArchivedPersonas (id, user, name, temp, toki_pona, last_used) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        archived += len(rows)
+        if len(rows) < ARCHIVE_BATCH:
+            return archived
+
+async def prune_settings():
+    # a row the same as the defaults says nothing that fetch_settings wouldn't work out anyway
+    same = " AND ".join(f"{name} = :{name}" for name in settings_defaults)
+    async with transaction(), db.execute(f"DELETE FROM Settings WHERE {same} RETURNING user", settings_defaults) as cur:
+        pruned = len(await cur.fetchall())
+
+    # otherwise, only forget people who have left, have no personas and haven't been seen for a while,
+    # and only once the member list is complete
+    guild = the_guild()
+    if not guild or not getattr(guild, "chunked", True):
+        return pruned
+    expire_users()
+    async with reading() as reader, reader.execute("SELECT user FROM Settings") as cur:
+        gone = [user for user, in await cur.fetchall() if not guild.get_member(user) and user not in personas_by_user and user not in last_active]
+    async with transaction():
+        await db.execute("DELETE FROM Settings WHERE user IN (SELECT value FROM json_each(?))", (json.dumps(gone),))
+    for user in gone:
+        settings_changed(user, {"user": user, **settings_defaults})
+    return pruned + len(gone)
+
+async def compact():
+    async with write_lock:
+        # VACUUM and friends can't run inside the transaction a group commit may still be waiting on
+        if db.in_transaction:
+            await db.commit()
+        async with db.execute("PRAGMA auto_vacuum") as cur:
+            auto_vacuum, = await cur.fetchone()
+        if auto_vacuum != 2:
+            # incremental vacuuming has to be switched on by one full VACUUM
+            logging.info("Switching the database to incremental vacuuming")
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await db.execute("VACUUM")
+        async with db.execute("PRAGMA freelist_count") as cur:
+            free, = await cur.fetchone()
+        # the pragma frees a page each time a row is stepped past, so it has to be read to the end
+        async with db.execute("PRAGMA incremental_vacuum") as cur:
+            await cur.fetchall()
+        async with db.execute("PRAGMA freelist_count") as cur:
+            left, = await cur.fetchone()
+        await db.execute("ANALYZE")
+    return free - left
+
+async def maintain():
+    async with maintaining:
+        start = time.perf_counter()
+        report = {"archived": await archive_personas()}
+        async with transaction(), db.execute("DELETE FROM SelectedPersona WHERE persona NOT IN (SELECT id FROM Personas WHERE active) RETURNING user") as cur:
+            report["selections_pruned"] = len(await cur.fetchall())
+        report["settings_pruned"] = await prune_settings()
+        report["pages_freed"] = await compact()
+        report["seconds"] = time.perf_counter() - start
+    logging.info("Maintenance done: %s", report)
+    return report
+
+async def try_maintain():
+    try:
+        await maintain()
+    except Exception:
+        logging.exception("Maintenance failed")
+
+# a run a worker asked for, which nothing in the gateway waits on
+maintenance_run = None
+
+@remote
+def maintain_for():
+    global maintenance_run
+    if not maintaining.locked() and not (maintenance_run and not maintenance_run.done()):
+        maintenance_run = asyncio.create_task(try_maintain())
+
+@routes.post("/maintenance")
+async def run_maintenance(request):
+    check_admin(request)
+    if mode == "api":
+        # only the gateway maintains the database, so that no two processes do it at once; its log has the report
+        tell("maintain_for")
+        return web.json_response({"result": "started"}, status=202)
+    if maintaining.locked():
+        raise web.HTTPConflict(text="Maintenance is already running.")
+    return web.json_response(await maintain())
+
+async def maintainer(_):
+    async def maintain_periodically():
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            await try_maintain()
+
+    task = asyncio.create_task(maintain_periodically())
+    yield
+    task.cancel()
+
+EVENT_BACKLOG = 1000
+EVENT_KEEPALIVE = 15
+# event ids are only meaningful to the process that gave them out; in a split deployment that is always the gateway
+EVENT_EPOCH = f"{time.time_ns():x}"
+
+# the most recent (number, JSON) events, for clients of /events to catch up from
+events = collections.deque(maxlen=EVENT_BACKLOG)
+event_count = 0
+new_event = asyncio.Event()
+
+def publish(type, **data):
+    if mode == "api":
+        tell("publish_for", type, data)
+    else:
+        add_event(event_count + 1, json.dumps({"type": type, **data}))
+        tell("add_event", event_count, events[-1][1])
+
+@remote
+def publish_for(type, data):
+    publish(type, **data)
+
+@remote
+def add_event(n, data):
+    global event_count, new_event
+    event_count = n
+    events.append((n, data))
+    new_event.set()
+    new_event = asyncio.Event()
+
+@remote
+def hello(epoch, n, backlog):
+    global EVENT_EPOCH, event_count
+    EVENT_EPOCH = epoch
+    event_count = n
+    events.clear()
+    events.extend(map(tuple, backlog))
+
+def parse_event_id(id):
+    epoch, _, n = id.partition("-")
+    if epoch == EVENT_EPOCH and n.isdigit():
+        return int(n)
+
+@routes.get("/events")
+async def event_stream(request):
+    cursor = request.headers.get("Last-Event-ID") or request.query.get("since")
+    seen = event_count if cursor is None else parse_event_id(cursor)
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await resp.prepare(request)
+    while True:
+        wake = new_event
+        if seen is None or not event_count - len(events) <= seen <= event_count:
+            # whatever the client missed is gone, so it has to fetch everything again
+            seen = event_count
+            await resp.write(f"id: {EVENT_EPOCH}-{seen}\nevent: reset\ndata: {{}}\n\n".encode())
+        for seen, data in [*itertools.islice(events, len(events) - (event_count - seen), None)]:
+            await resp.write(f"id: {EVENT_EPOCH}-{seen}\ndata: {data}\n\n".encode())
+        try:
+            await asyncio.wait_for(wake.wait(), EVENT_KEEPALIVE)
+        except TimeoutError:
+            await resp.write(b": keepalive\n\n")
 
 
 intents = discord.Intents(
@@ -290,73 +1204,238 @@ bot = commands.Bot(
     help_command=commands.DefaultHelpCommand(width=120, no_category="Commands"),
 )
 
+@bot.listen()
+async def on_ready():
+    tell("mirror_guild", guild_snapshot())
+
+@bot.listen()
+async def on_member_join(member):
+    if member.guild.id == config.guild_id:
+        tell("mirror_member", member.id, [role.id for role in member.roles])
+        publish("member_join", user=member.id)
+
+@bot.listen()
+async def on_member_remove(member):
+    if member.guild.id == config.guild_id:
+        tell("mirror_member", member.id, None)
+        publish("member_leave", user=member.id)
+
+@bot.listen()
+async def on_member_update(before, after):
+    if after.guild.id == config.guild_id and before.roles != after.roles:
+        tell("mirror_member", after.id, [role.id for role in after.roles])
+        publish("member_roles", user=after.id, roles=[role.id for role in after.roles])
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = time.perf_counter()
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    observe("canon_command_seconds", time.perf_counter() - ctx.started, command=ctx.command.qualified_name)
+
 @bot.event
 async def on_command_error(ctx, exc, old_command_error=bot.on_command_error):
     if isinstance(exc, commands.CommandNotFound):
         return
     if isinstance(exc, commands.UserInputError):
         return await ctx.send(exc)
-    await db.rollback()
     await old_command_error(ctx, exc)
 
 if config.cg_url:
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    CG_TTL = 30
+
+    # the last status read from cg_url, what to revalidate it with, and the request refreshing it if one is running
+    cg_status = None
+    cg_checked = 0
+    cg_validators = {}
+    cg_refresh = None
+
+    async def refresh_cg_status():
+        global cg_status, cg_checked, cg_validators, cg_refresh
+        try:
+            async with session.get(config.cg_url, headers=cg_validators) as resp:
+                if resp.status != 304:
+                    resp.raise_for_status()
+                    soup = BeautifulSoup(await resp.text(), "lxml", parse_only=SoupStrainer(["time", "h1"]))
+                    header = soup.find("h1")
+                    cg_status = {
+                        "deadline": datetime.datetime.fromisoformat(soup.find_all("time")[-1]["datetime"]),
+                        "stage": "waiting" if not header else "uploading" if "stage 1" in header.get_text() else "guessing",
+                    }
+                    cg_validators = {ours: resp.headers[theirs] for ours, theirs in [("If-None-Match", "ETag"), ("If-Modified-Since", "Last-Modified")] if theirs in resp.headers}
+            cg_checked = time.monotonic()
+            return cg_status
+        finally:
+            cg_refresh = None
+
+    async def fetch_cg_status():
+        global cg_refresh
+        if cg_status and time.monotonic() - cg_checked < CG_TTL:
+            return cg_status
+        if not cg_refresh:
+            cg_refresh = asyncio.create_task(refresh_cg_status())
+        return await asyncio.shield(cg_refresh)
+
+    @routes.get("/cg")
+    async def get_cg(request):
+        status = await fetch_cg_status()
+        return web.json_response({"deadline": status["deadline"].isoformat(), "stage": status["stage"]})
+
     @bot.command()
     async def cg(ctx):
         """Current information about code guessing."""
-        async with session.get(config.cg_url) as resp:
-            soup = BeautifulSoup(await resp.text(), "lxml")
-        target = datetime.datetime.fromisoformat(soup.find_all("time")[-1]["datetime"])
+        status = await fetch_cg_status()
+        target = status["deadline"]
         when = discord.utils.format_dt(target, "R") if datetime.datetime.now(datetime.timezone.utc) < target else "**when someone wakes up**"
-        header = soup.find("h1")
-        if not header:
+        if status["stage"] == "waiting":
             await ctx.send(f"The next round will start {when}.")
-        elif "stage 1" in header.string:
+        elif status["stage"] == "uploading":
             await ctx.send(f"The uploading stage will end {when}.")
         else:
             await ctx.send(f"The round will end {when}.")
 
 
 class Persona:
+    __slots__ = ("id", "user_id", "name", "active", "temp", "toki_pona", "last_used")
+
     def __init__(self, row):
         self.id = row["id"]
+        self.user_id = row["user"]
         self.name = row["name"]
-        self.user = bot.get_user(row["user"])
+        self.active = row["active"]
         self.temp = row["temp"]
+        self.toki_pona = row["toki_pona"]
+        self.last_used = row["last_used"]
 
     def __eq__(self, other):
         return isinstance(other, Persona) and self.id == other.id
 
     @classmethod
     async def convert(cls, ctx, argument):
-        async with db.execute("SELECT * FROM Personas WHERE active AND name = ?", (argument,)) as cur:
-            r = await cur.fetchone()
-        if r:
-            return cls(r)
+        if p := personas_by_name.get(argument):
+            return p
         raise commands.BadArgument(f"Persona '{argument}' not found.")
 
+    @property
+    def user(self):
+        return get_user(self.user_id)
+
     @property
     def mention(self):
         return self.name
 
+INACTIVE_CACHE_SIZE = 4096
+
+# every active persona, loaded in database() and kept up to date by every write to Personas
+personas_by_id = {}
+# least recently looked up inactive personas, which old messages are still attributed to
+inactive_personas = collections.OrderedDict()
+# active personas only
+personas_by_name = {}
+personas_by_user = {}
+# mirror of SelectedPersona, from user id to persona id
+selected = {}
+
+@shared
+def register(row):
+    p = personas_by_id[row["id"]] = Persona(row)
+    if p.active:
+        personas_by_name[p.name] = p
+        personas_by_user.setdefault(p.user_id, {})[p.id] = p
+
+@shared
+def retire(id):
+    if not (p := personas_by_id.get(id)) or not p.active:
+        return
+    p.active = 0
+    del personas_by_id[id]
+    cache_inactive(p)
+    del personas_by_name[p.name]
+    del personas_by_user[p.user_id][id]
+    if not personas_by_user[p.user_id]:
+        del personas_by_user[p.user_id]
+    if selected.get(p.user_id) == id:
+        del selected[p.user_id]
+
+@shared
+def rename(id, name):
+    if not (p := personas_by_id.get(id) or inactive_personas.get(id)):
+        return
+    if p.active:
+        del personas_by_name[p.name]
+        personas_by_name[name] = p
+    p.name = name
+
+@shared
+def touch(ids, when):
+    for id in ids:
+        if p := personas_by_id.get(id) or inactive_personas.get(id):
+            p.last_used = when
+
+@shared
+def set_selected(user, id):
+    if id is None:
+        selected.pop(user, None)
+    else:
+        selected[user] = id
+
+def cache_inactive(p):
+    inactive_personas[p.id] = p
+    inactive_personas.move_to_end(p.id)
+    if len(inactive_personas) > INACTIVE_CACHE_SIZE:
+        inactive_personas.popitem(last=False)
+
 async def get_persona(id):
-    async with db.execute("SELECT * FROM Personas WHERE id = ?", (id,)) as cur:
+    if p := personas_by_id.get(id):
+        return p
+    if p := inactive_personas.get(id):
+        inactive_personas.move_to_end(id)
+        return p
+    async with reading() as reader, reader.execute(
+        "SELECT * FROM Personas WHERE id = ?1 UNION ALL SELECT id, user, name, 0, temp, toki_pona, last_used FROM ArchivedPersonas WHERE id = ?1", (id,)
+    ) as cur:
         r = await cur.fetchone()
     if r:
-        return Persona(r)
+        p = Persona(r)
+        # an inactive persona can only be renamed, which rename() takes care of, so it's safe to keep;
+        # an active one missing from the registry was just made elsewhere, and register() will bring it
+        if not p.active:
+            cache_inactive(p)
+        return p
 
 async def get_target(id):
+    if mode == "api":
+        # channels and users are only known to the gateway, and persona ids can't be mistaken for either
+        return await get_persona(id) or discord.Object(id)
     return bot.get_channel(id) or bot.get_user(id) or await get_persona(id)
 
+# mirror of AnonConnections as an adjacency map, loaded in database() and updated after every commit that touches it
+links = {}
+
+@shared
+def link(a, b):
+    links.setdefault(a, set()).add(b)
+    links.setdefault(b, set()).add(a)
+
+@shared
+def unlink(x):
+    for y in links.pop(x, ()):
+        if y != x:
+            links[y].discard(x)
+            if not links[y]:
+                del links[y]
+
 async def connections(target_id):
-    async with db.execute("SELECT a FROM AnonConnections WHERE b = ?1 UNION ALL SELECT b FROM AnonConnections WHERE a = ?1", (target_id,)) as cur:
-        return [await get_target(x[0]) for x in await cur.fetchall()]
+    return [await get_target(x) for x in links.get(target_id, ())]
 
 async def selected_persona(user):
-    async with db.execute("SELECT Personas.* FROM SelectedPersona INNER JOIN Personas ON id = persona WHERE SelectedPersona.user = ?", (user.id,)) as cur:
-        r = await cur.fetchone()
-    return Persona(r) if r else user
+    return personas_by_id.get(selected.get(user.id)) or user
 
 @bot.listen()
+@timed_handler("canon_listener_seconds", listener="relay")
 async def on_message(message):
     if message.author == bot.user or message.content.startswith("!"):
         return
@@ -379,26 +1458,39 @@ async def on_message(message):
         targets.add(conn)
     targets -= {message.author, None}
 
+    # download each attachment once, however many places it's going
+    attachments = [*zip(message.attachments, await asyncio.gather(*[f.read() for f in message.attachments]))]
     for target in targets:
-        await target.send(f"<{our_name}> {text}", files=[await f.to_file() for f in message.attachments])
+        outbox.send(target, f"<{our_name}> {text}", route="relay", attachments=attachments)
 
 Target = Persona | discord.TextChannel | discord.User
 
+# held while a connection is being made to or from the persona or user with that id
+connecting = weakref.WeakValueDictionary()
+
+@contextlib.asynccontextmanager
+async def connecting_locks(*ids):
+    # taken in a consistent order so that two handshakes can't deadlock
+    locks = [connecting.setdefault(id, asyncio.Lock()) for id in sorted(set(ids))]
+    async with contextlib.AsyncExitStack() as stack:
+        for lock in locks:
+            await stack.enter_async_context(lock)
+        yield
+
 @commands.dm_only()
-@commands.max_concurrency(1, wait=True)
 @bot.group(invoke_without_command=True)
 async def anon(ctx, target=commands.param(converter=Target, description="Persona, channel, or user to connect to")):
     """Anonymously message a user or channel, for use in DMs only."""
-    try:
-        # find which persona we are
-        we_are = await selected_persona(ctx.author)
-        if we_are == ctx.author:
-            for we_are in await fetch_personas(ctx.author.id):
-                if await connections(we_are.id):
-                    continue
-                await db.execute("INSERT INTO SelectedPersona (user, persona) VALUES (?, ?)", (ctx.author.id, we_are.id))
+    # find which persona we are
+    we_are = await selected_persona(ctx.author)
+    if select := we_are == ctx.author:
+        for we_are in await fetch_personas(ctx.author.id):
+            if not await connections(we_are.id):
                 break
 
+    # channels can have any number of connections, so they don't need locking
+    involved = [we_are.id] if isinstance(target, discord.TextChannel) else [we_are.id, target.id]
+    async with connecting_locks(*involved):
         if await connections(we_are.id):
             return await ctx.send("You are already in a connection.")
         if not isinstance(target, discord.TextChannel) and await connections(target.id):
@@ -431,12 +1523,15 @@ async def anon(ctx, target=commands.param(converter=Target, description="Persona
                 await target.user.send("An anonymous user ({we_are.name}) is messaging your persona **{target.name}** anonymously. They do not know who controls it. Messages you send from now on will be sent to them. Use `!anon stop` to hang up at any time.")
 
         # form connection
-        await db.execute("INSERT INTO AnonConnections (a, b) VALUES (?, ?)", (we_are.id, target.id))
-        await db.commit()
+        async with transaction():
+            if select:
+                await db.execute("INSERT INTO SelectedPersona (user, persona) VALUES (?, ?)", (ctx.author.id, we_are.id))
+            await db.execute("INSERT INTO AnonConnections (a, b) VALUES (?, ?)", (we_are.id, target.id))
+        if select:
+            set_selected(ctx.author.id, we_are.id)
+        link(we_are.id, target.id)
 
         await ctx.send(f"Now connected to {target.mention} as **{we_are.name}**. Use `!anon stop` to disconnect.\nMessages (except commands) sent here will be relayed {there}. Disable automatic normalisation for a single message by prefixing it with `\\`.\n**NOTE**: Full anonymity is not guaranteed. Privileged users can access your identity.")
-    finally:
-        await db.rollback()
 
 @anon.command(aliases=["ls"])
 async def who(ctx):
@@ -447,13 +1542,8 @@ async def who(ctx):
     if ctx.guild:
         await ctx.send("\n".join(f"- {conn.mention}" for conn in await connections(ctx.channel.id) if conn) or "Nobody!")
     else:
-        async with db.execute(
-            "WITH us (id) AS (VALUES (?1) UNION ALL SELECT id FROM Personas WHERE user = ?1)"
-            "SELECT id, a FROM us INNER JOIN AnonConnections ON b = id "
-            "UNION ALL SELECT id, b FROM us INNER JOIN AnonConnections ON a = id",
-            (ctx.author.id,),
-        ) as cur:
-            r = await cur.fetchall()
+        us = [ctx.author.id, *personas_by_user.get(ctx.author.id, ())]
+        r = [(id, conn) for id in us for conn in links.get(id, ())]
 
         selected = await selected_persona(ctx.author)
         main = f"You are not connected to anyone as {selected.mention}."
@@ -488,12 +1578,12 @@ async def switch(ctx, *, target = commands.Author.replace(annotation=Target, des
     else:
         return await ctx.send(f"{target.mention} is not you nor one of your connections.")
 
-    if to == ctx.author:
-        await db.execute("DELETE FROM SelectedPersona WHERE user = ?", (ctx.author.id,))
-    else:
-        await db.execute("INSERT OR REPLACE INTO SelectedPersona (user, persona) VALUES (?, ?)", (ctx.author.id, to.id))
-
-    await db.commit()
+    async with transaction():
+        if to == ctx.author:
+            await db.execute("DELETE FROM SelectedPersona WHERE user = ?", (ctx.author.id,))
+        else:
+            await db.execute("INSERT OR REPLACE INTO SelectedPersona (user, persona) VALUES (?, ?)", (ctx.author.id, to.id))
+    set_selected(ctx.author.id, None if to == ctx.author else to.id)
 
     if conns := await connections(to.id):
         await ctx.send(f"Switched to {to.mention}. Your messages are now being sent to {conns[0].mention}. Use `!anon stop` to disconnect.")
@@ -505,9 +1595,9 @@ async def switch(ctx, *, target = commands.Author.replace(annotation=Target, des
 async def stop(ctx):
     """Disconnect from the current session."""
     we_are = await selected_persona(ctx.author)
-    async with db.execute("DELETE FROM AnonConnections WHERE a = ?1 OR b = ?1 RETURNING a, b", (we_are.id,)) as cur:
+    async with transaction(), db.execute("DELETE FROM AnonConnections WHERE a = ?1 OR b = ?1 RETURNING a, b", (we_are.id,)) as cur:
         r = await cur.fetchone()
-    await db.commit()
+    unlink(we_are.id)
     if not r:
         return await ctx.send(f"{we_are.mention} is not connected anywhere.")
     for x in r:
@@ -532,18 +1622,23 @@ async def add(ctx, *, name=commands.param(description="Name of the persona to cr
     """Create a new persona."""
     if await conflicts(name):
         return await ctx.send("That name is taken or reserved.")
-    await db.execute("INSERT INTO Personas (user, name) VALUES (?, ?)", (ctx.author.id, name))
-    await db.commit()
+    try:
+        async with transaction(), db.execute("INSERT INTO Personas (user, name) VALUES (?, ?) RETURNING *", (ctx.author.id, name)) as cur:
+            row = dict(await cur.fetchone())
+    except sqlite3.IntegrityError:
+        return await ctx.send("That name is taken or reserved.")
+    register(row)
+    take_name(name)
+    publish("persona_create", id=row["id"], user=ctx.author.id, name=name, temp=False)
     await ctx.send(f"Created a persona named '{name}'.")
 
 @commands.dm_only()
 @personas.command(aliases=["delete", "del", "rm", "nix"])
 async def remove(ctx, *, name=commands.param(description="Name of the persona to remove")):
     """Remove a persona."""
-    async with db.execute("SELECT id FROM Personas WHERE active AND user = ? AND name = ?", (ctx.author.id, name)) as cur:
-        if not (r := await cur.fetchone()):
-            return await ctx.send(f"You have no persona named '{name}'.")
-    await un_persona(r[0])
+    if not (p := personas_by_name.get(name)) or p.user_id != ctx.author.id:
+        return await ctx.send(f"You have no persona named '{name}'.")
+    await un_persona(p.id)
     await ctx.send(f"Deleted persona '{name}'.")
 
 def cfg_norm(s):
@@ -597,37 +1692,77 @@ if config.rotg_channel:
     @bot.group(invoke_without_command=True)
     async def meow(ctx, *, what):
         """Begin treating a given word as a 'meow'."""
-        await db.execute("INSERT OR IGNORE INTO Meows (meow) VALUES (?)", (what,))
-        await db.commit()
+        async with transaction():
+            await db.execute("INSERT OR IGNORE INTO Meows (meow) VALUES (?)", (what,))
+        meow_patterns[what] = re.compile(meow_pattern(what))
+        combine_meows()
         await ctx.send("🐱")
 
     @meow.command(aliases=["remove"])
     async def un(ctx, *, what):
         """Stop treating a given word as a meow."""
-        await db.execute("DELETE FROM Meows WHERE meow = ?", (what,))
-        await db.commit()
+        async with transaction():
+            await db.execute("DELETE FROM Meows WHERE meow = ?", (what,))
+        meow_patterns.pop(what, None)
+        combine_meows()
         await ctx.send("😼")
 
     @meow.command()
     async def list(ctx):
         """List all words currently being treated as meows."""
-        async with db.execute("SELECT meow FROM Meows") as cur:
+        async with reading() as reader, reader.execute("SELECT meow FROM Meows") as cur:
             await ctx.send("\n".join(f"- {meow}" for meow, in await cur.fetchall()))
 
+    MEOW_FLUSH_INTERVAL = 10
+
+    # meows counted since UserMeows was last written to
+    pending_meows = collections.Counter()
+    # held while a batch is on its way to UserMeows, so that a new round can't start underneath it
+    flushing = asyncio.Lock()
+
+    async def flush_meows():
+        async with flushing:
+            if not pending_meows:
+                return
+            batch = pending_meows.copy()
+            pending_meows.clear()
+            try:
+                async with transaction():
+                    await db.executemany("INSERT INTO UserMeows (user, count) VALUES (?1, ?2) ON CONFLICT (user) DO UPDATE SET count = count + ?2", batch.items())
+            except BaseException:
+                pending_meows.update(batch)
+                raise
+
+    async def meow_flusher(_):
+        async def flush_periodically():
+            while True:
+                await asyncio.sleep(MEOW_FLUSH_INTERVAL)
+                try:
+                    await flush_meows()
+                except Exception:
+                    logging.exception("Failed to flush meow counts")
+
+        task = asyncio.create_task(flush_periodically())
+        yield
+        task.cancel()
+        await flush_meows()
+
     async def generate_table():
         count = 0
         table = []
-        async with db.execute("SELECT user, count FROM UserMeows ORDER BY count DESC") as cur:
-            rows = await cur.fetchall()
-        for place, user in enumerate(rows, start=1):
-            count += user["count"]
-            table.append(f"{place}. <@{user['user']}> - {user['count']}")
+        async with reading() as reader, reader.execute("SELECT user, count FROM UserMeows") as cur:
+            counts = collections.Counter(dict(await cur.fetchall()))
+        counts.update(pending_meows)
+        for place, (user, n) in enumerate(counts.most_common(), start=1):
+            count += n
+            table.append(f"{place}. <@{user}> - {n}")
         return count, "\n".join(table)
 
     @meow.command()
     async def info(ctx):
         """Request all tracked meow information."""
-        async with db.execute("SELECT UNIXEPOCH() - time_started FROM MeowInfo") as cur:
+        await flush_meows()
+        async with reading() as reader, reader.execute("SELECT UNIXEPOCH() - time_started FROM MeowInfo") as cur:
             total_time, = await cur.fetchone()
         if not total_time:
             return await ctx.send("No round is running.")
@@ -642,55 +1777,243 @@ if config.rotg_channel:
     @only_from(config.rotg_admin)
     async def start(ctx):
         """Start counting meows."""
-        await db.execute("UPDATE MeowInfo SET time_started = COALESCE(time_started, UNIXEPOCH())")
-        await db.execute("DELETE FROM UserMeows")
-        await db.commit()
+        async with flushing:
+            async with transaction():
+                await db.execute("UPDATE MeowInfo SET time_started = COALESCE(time_started, UNIXEPOCH())")
+                await db.execute("DELETE FROM UserMeows")
+            pending_meows.clear()
         await ctx.send("🎬")
 
     @meow.command()
     @only_from(config.rotg_admin)
     async def stop(ctx):
         """Stop counting meows."""
-        await db.execute("UPDATE MeowInfo SET time_started = NULL")
-        await db.commit()
+        async with transaction():
+            await db.execute("UPDATE MeowInfo SET time_started = NULL")
+        await flush_meows()
         await ctx.send("🎬")
 
-    def count_matches(needle, haystack):
+    def meow_pattern(needle):
         # this is really stupid lol
-        pattern = re.sub(r"(\\\s)+", r"\\s+", re.sub(r"\b", r"\\b", re.escape(needle), flags=re.I))
-        return len(re.findall(pattern, haystack))
+        return re.sub(r"(\\\s)+", r"\\s+", re.sub(r"\b", r"\\b", re.escape(needle), flags=re.I))
+
+    # compiled pattern for each meow, and all of them in one alternation to skip messages with no meows quickly
+    meow_patterns = {}
+    any_meow = None
+
+    def combine_meows():
+        global any_meow
+        any_meow = re.compile("|".join(f"(?:{p.pattern})" for p in meow_patterns.values())) if meow_patterns else None
+
+    async def load_meows():
+        async with db.execute("SELECT meow FROM Meows") as cur:
+            async for meow, in cur:
+                meow_patterns[meow] = re.compile(meow_pattern(meow))
+        combine_meows()
 
     @bot.listen()
+    @timed_handler("canon_listener_seconds", listener="meows")
     async def on_message(message):
         if message.author.bot or message.channel.id != config.rotg_channel or message.content.startswith("!"):
             return
-        c = 0
-        async with db.execute("SELECT meow FROM Meows") as cur:
-            async for meow, in cur:
-                c += count_matches(meow, message.content)
-        if c:
-            await db.execute("INSERT INTO UserMeows (user, count) VALUES (?1, ?2) ON CONFLICT (user) DO UPDATE SET count = count + ?2", (message.author.id, c))
-            await db.commit()
+        if not any_meow or not any_meow.search(message.content):
+            return
+        # each meow is counted separately, so overlapping meows both count
+        c = sum(len(p.findall(message.content)) for p in meow_patterns.values())
+        pending_meows[message.author.id] += c
+
 
+# schema.sql is version 0; each entry upgrades the database to the next PRAGMA user_version
+# append new migrations to the end, never edit ones that have shipped
+MIGRATIONS = [
+    """
+    -- older versions could give two active personas the same name; only the newest keeps it
+    UPDATE Personas SET active = 0 WHERE active AND id < (SELECT MAX(id) FROM Personas AS p WHERE p.active AND p.name = Personas.name);
+    DELETE FROM AnonConnections WHERE a IN (SELECT id FROM Personas WHERE NOT active) OR b IN (SELECT id FROM Personas WHERE NOT active);
+    DELETE FROM SelectedPersona WHERE persona IN (SELECT id FROM Personas WHERE NOT active);
+    CREATE UNIQUE INDEX PersonasByName ON Personas (name) WHERE active;
+    CREATE INDEX PersonasByUser ON Personas (user, last_used) WHERE active;
+    CREATE INDEX AnonConnectionsByA ON AnonConnections (a, b);
+    CREATE INDEX AnonConnectionsByB ON AnonConnections (b, a);
+    """,
+    """
+    CREATE TABLE ArchivedPersonas (
+        id INTEGER PRIMARY KEY,
+        user INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        temp INTEGER NOT NULL DEFAULT 0,
+        toki_pona INTEGER NOT NULL DEFAULT 0,
+        last_used INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX ArchivedPersonasByUser ON ArchivedPersonas (user, last_used);
+    """,
+]
+
+async def migrate():
+    async with db.execute("PRAGMA user_version") as cur:
+        version, = await cur.fetchone()
+    for version, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        await db.executescript(f"BEGIN; {script}; PRAGMA user_version = {version}; COMMIT;")
 
 async def database(_):
     global db
-    async with aiosqlite.connect("the.db", autocommit=False) as db:
+    # transactions are managed by transaction() rather than by sqlite3
+    async with aiosqlite.connect("the.db", isolation_level=None) as db:
         db.row_factory = aiosqlite.Row
-        yield
-
-async def the_bot(_):
+        time_statements(db)
+        await db.execute("PRAGMA journal_mode = WAL")
+        await db.execute("PRAGMA synchronous = NORMAL")
+        await migrate()
+        async with db.execute("SELECT name, dflt_value FROM pragma_table_info('Settings') WHERE NOT pk") as cur:
+            settings_defaults.update({name: int(default) for name, default in await cur.fetchall()})
+        await load_activity()
+        async with db.execute("SELECT * FROM Personas WHERE active") as cur:
+            async for row in cur:
+                register(row)
+        async with db.execute("SELECT user, persona FROM SelectedPersona") as cur:
+            selected.update(await cur.fetchall())
+        await load_names()
+        if config.rotg_channel:
+            await load_meows()
+        async with db.execute("SELECT a, b FROM AnonConnections") as cur:
+            async for a, b in cur:
+                link(a, b)
+        for _ in range(READERS):
+            readers.put_nowait(await open_reader())
+        loaded.set()
+        try:
+            yield
+        finally:
+            while not readers.empty():
+                await readers.get_nowait().close()
+
+async def http_session(_):
     global session
     async with aiohttp.ClientSession(headers={"User-Agent": "Canon"}) as session:
-        task = asyncio.create_task(bot.start(config.token))
         yield
+
+async def the_bot(_):
+    task = asyncio.create_task(bot.start(config.token))
+    yield
+    await outbox.drain(30)
     await bot.close()
 
-app = web.Application()
+# generous, since the gateway sends every member and the event backlog in one line each
+IPC_LINE_LIMIT = 2**24
+
+# set once database() has read everything, so that changes from other processes aren't lost under it
+loaded = asyncio.Event()
+
+async def worker_server(_):
+    async def serve(reader, writer):
+        writer.write(ipc_message("hello", EVENT_EPOCH, event_count, [*events]))
+        writer.write(ipc_message("mirror_guild", guild_snapshot()))
+        peers.append(writer)
+        try:
+            async for message in reader:
+                op, args = json.loads(message)
+                try:
+                    remote_ops[op](*args)
+                except Exception:
+                    logging.exception("Failed to run %s for a worker", op)
+                if op in shared_ops:
+                    tell(op, *args, skip=writer)
+        finally:
+            peers.remove(writer)
+            writer.close()
+
+    server = await asyncio.start_unix_server(serve, config.ipc_path, limit=IPC_LINE_LIMIT, start_serving=False)
+    # any op can be run over the socket, so only the bot's own user may connect, and not before that's so
+    os.chmod(config.ipc_path, 0o600)
+    await server.start_serving()
+    yield
+    server.close()
+    for writer in peers:
+        writer.close()
+
+async def gateway_link(_):
+    # the gateway only listens once it has migrated the database, so connecting first means it's safe to open
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(config.ipc_path, limit=IPC_LINE_LIMIT)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            logging.info("Waiting for the gateway at %s", config.ipc_path)
+            await asyncio.sleep(1)
+
+    async def listen():
+        await loaded.wait()
+        peers.append(writer)
+        async for message in reader:
+            op, args = json.loads(message)
+            try:
+                remote_ops[op](*args)
+            except Exception:
+                logging.exception("Failed to run %s for the gateway", op)
+        # everything this worker knows could now be out of date, so start again from scratch
+        logging.critical("Lost connection to the gateway, shutting down")
+        signal.raise_signal(signal.SIGTERM)
+
+    task = asyncio.create_task(listen())
+    yield
+    task.cancel()
+    writer.close()
+
+app = web.Application(middlewares=[time_requests])
 app.add_routes(routes)
 
-app.cleanup_ctx.append(database)
-if config.token:
-    app.cleanup_ctx.append(the_bot)
-
-web.run_app(app, port=40543)
+def startup_phase(ctx):
+    @functools.wraps(ctx)
+    async def wrapper(app):
+        start = time.perf_counter()
+        gen = ctx(app)
+        await anext(gen)
+        startup_times[ctx.__name__] = time.perf_counter() - start
+        yield
+        await anext(gen, None)
+    return wrapper
+
+async def report_startup(app):
+    startup_times["total"] = time.perf_counter() - started
+    logging.info("Started in %.2fs (%s)", startup_times["total"], ", ".join(f"{phase} {t:.3f}s" for phase, t in startup_times.items() if phase != "total"))
+
+def setup(how):
+    global mode, outbox
+    mode = how
+    startup_times["module"] = time.perf_counter() - started - startup_times["imports"]
+    ctxs = [loop_monitor]
+    if mode == "api":
+        outbox = ForwardingOutbox()
+        ctxs.append(gateway_link)
+    ctxs.append(database)
+    if mode != "api":
+        ctxs.append(maintainer)
+    if config.rotg_channel and mode != "api":
+        ctxs.append(meow_flusher)
+    if config.cg_url:
+        ctxs.append(http_session)
+    if config.token and mode != "api":
+        ctxs.append(the_bot)
+    if mode == "gateway":
+        ctxs.append(worker_server)
+    app.cleanup_ctx.extend(map(startup_phase, ctxs))
+    app.on_startup.append(report_startup)
+
+async def run_gateway():
+    runner = web.AppRunner(app)
+    await runner.setup()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await runner.cleanup()
+
+if __name__ == "__main__":
+    how = sys.argv[1] if len(sys.argv) > 1 else "all"
+    if how not in ("all", "gateway", "api"):
+        sys.exit("usage: python canon.py [all | gateway | api]")
+    setup(how)
+    if mode == "gateway":
+        asyncio.run(run_gateway())
+    else:
+        web.run_app(app, port=40543, reuse_port=mode == "api")
@@ -17,3 +17,25 @@ cg_url = None
 # leave as None
 rotg_admin = None
 rotg_channel = None
+
+# GPT rewriting of anonymous messages
+# Most requests to the model in flight at once
+gpt_concurrency = 4
+# Seconds a message may spend waiting for its rewrite, including queueing and retries
+gpt_timeout = 20
+# If the rewrite fails or runs out of time, lowercase and strip punctuation instead of failing the message
+gpt_fallback = True
+# Optional async function taking and returning text, used instead of OpenAI (e.g. for tests)
+gpt_backend = None
+
+# Optional number of seconds to hold comment notifications for, so that several for the same user are sent as one DM
+notify_digest_window = None
+
+# Optional secret for admin-only HTTP endpoints, sent as "Authorization: Bearer <admin_token>"
+# Without this, those endpoints are disabled
+admin_token = None
+
+# Unix socket the gateway and API workers talk over when running as separate processes
+# (python canon.py gateway, then any number of python canon.py api)
+# it is made readable by the bot's user only, and should be somewhere other users can't replace it
+ipc_path = "canon.sock"